@@ -1,55 +1,134 @@
 import pandas as pd
+import numpy as np
 import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
 import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # ===============================
 # CONFIG
 # ===============================
 INPUT_CSV = "datasets/fuel_prices_us_unique.csv"
 OUTPUT_CSV = "datasets/truckstops_geocoded.csv"
-CACHE_FILE = "geocode_cache.json"
+PROGRESS_CSV = "datasets/truckstops_geocoded.progress.csv"  # checkpoints (fila, lat, lon) en modo append
+CACHE_FILE = "geocode_cache.sqlite"
+LEGACY_CACHE_JSON = "geocode_cache.json"
 SAVE_EVERY = 50
+MAX_WORKERS = 4
+RATE_LIMIT_SECONDS = 1.0  # política de Nominatim: 1 req/s
 USER_AGENT = "Mozilla/5.0 (compatible; GeocoderBot/1.0)"
 
 # ===============================
-# CACHE
+# SESIÓN HTTP (keep-alive)
 # ===============================
-if os.path.exists(CACHE_FILE):
-    with open(CACHE_FILE, "r", encoding="utf-8") as f:
-        cache = json.load(f)
-else:
-    cache = {}
+# Una única sesión reutiliza la conexión TCP+TLS con Nominatim entre consultas.
+# Los 429/5xx se reintentan con backoff sobre el mismo socket.
+SESSION = requests.Session()
+SESSION.headers.update({"User-Agent": USER_AGENT})
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=MAX_WORKERS,
+    max_retries=Retry(total=3, backoff_factor=1, status_forcelist=[429, 502, 503, 504]),
+))
+
+# ===============================
+# CACHE (SQLite + WAL)
+# ===============================
+# Cada resultado se inserta como una fila (q, lat, lon); lat/lon NULL marca una
+# consulta ya intentada sin resultado. Guardar ya no reescribe toda la caché.
+_cache_lock = threading.Lock()
+cache_conn = sqlite3.connect(CACHE_FILE, check_same_thread=False)
+cache_conn.execute("PRAGMA journal_mode=WAL")
+cache_conn.execute("CREATE TABLE IF NOT EXISTS geo(q TEXT PRIMARY KEY, lat REAL, lon REAL)")
+
+# Migración única desde la caché JSON anterior
+if os.path.exists(LEGACY_CACHE_JSON) and not cache_conn.execute("SELECT 1 FROM geo LIMIT 1").fetchone():
+    with open(LEGACY_CACHE_JSON, "r", encoding="utf-8") as f:
+        legacy = json.load(f)
+    cache_conn.executemany(
+        "INSERT OR REPLACE INTO geo VALUES (?,?,?)",
+        [(q, *(v if v else (None, None))) for q, v in legacy.items()]
+    )
+    cache_conn.commit()
+
+_MISS = object()
+
+def cache_get(q_norm):
+    """Devuelve (lat, lon), None si es una consulta fallida conocida, o _MISS."""
+    with _cache_lock:
+        row = cache_conn.execute("SELECT lat, lon FROM geo WHERE q=?", (q_norm,)).fetchone()
+    if row is None:
+        return _MISS
+    return None if row[0] is None else row
+
+def cache_put(q_norm, coords):
+    lat, lon = coords if coords else (None, None)
+    with _cache_lock:
+        cache_conn.execute("INSERT OR REPLACE INTO geo VALUES (?,?,?)", (q_norm, lat, lon))
+
+def cache_commit():
+    with _cache_lock:
+        cache_conn.commit()
 
 def normalize(text):
     return text.lower().strip() if text else ""
 
+# ===============================
+# RATE LIMITER (global, 1 req/s)
+# ===============================
+# Cada hilo reserva el próximo turno libre bajo lock y duerme fuera de él,
+# así las esperas de red se solapan sin superar la tasa permitida.
+_rate_lock = threading.Lock()
+_next_allowed_ts = 0.0
+_stop_requests = threading.Event() # se activa al interrumpir: no salen más peticiones
+
+def wait_for_rate_limit():
+    global _next_allowed_ts
+    with _rate_lock:
+        now = time.monotonic()
+        slot = max(now, _next_allowed_ts)
+        _next_allowed_ts = slot + RATE_LIMIT_SECONDS
+    if slot > now:
+        time.sleep(slot - now)
+
 # ===============================
 # GEOCODER
 # ===============================
 def geocode(query):
     q_norm = normalize(query)
-    if q_norm in cache:
-        return cache[q_norm]
+    cached = cache_get(q_norm)
+    if cached is not _MISS:
+        return cached
 
     url = "https://nominatim.openstreetmap.org/search"
     params = {"q": query, "format": "json", "limit": 1}
-    headers = {"User-Agent": USER_AGENT}
 
     try:
-        resp = requests.get(url, params=params, headers=headers, timeout=10)
+        # Sólo se espera antes de una petición real (los hits de caché salen arriba).
+        # Tras la espera se revisa de nuevo: otro hilo pudo resolver la misma consulta.
+        wait_for_rate_limit()
+        if _stop_requests.is_set():
+            return None
+        cached = cache_get(q_norm)
+        if cached is not _MISS:
+            return cached
+        resp = SESSION.get(url, params=params, timeout=10)
         if resp.status_code == 200:
             data = resp.json()
             if data:
-                lat, lon = data[0]["lat"], data[0]["lon"]
-                cache[q_norm] = (lat, lon)
+                lat, lon = float(data[0]["lat"]), float(data[0]["lon"])
+                cache_put(q_norm, (lat, lon))
                 return lat, lon
 
     except:
         pass
 
-    cache[q_norm] = None
+    cache_put(q_norm, None)
     return None
 
 
@@ -62,62 +141,119 @@ if os.path.exists(OUTPUT_CSV):
     df_out = pd.read_csv(OUTPUT_CSV)
 else:
     df_out = df.copy()
-    df_out["latitude"] = None
-    df_out["longitude"] = None
+    df_out["latitude"] = np.nan
+    df_out["longitude"] = np.nan
+
+# Reanudar desde los checkpoints de una ejecución interrumpida
+if os.path.exists(PROGRESS_CSV):
+    progress = pd.read_csv(PROGRESS_CSV)
+    df_out.loc[progress["row"], ["latitude", "longitude"]] = progress[["latitude", "longitude"]].to_numpy()
 
 
 # ===============================
 # PROCESAMIENTO
 # ===============================
-changes_since_save = 0
-
-for i in range(len(df_out)):
-    if pd.notna(df_out.at[i, "latitude"]) and pd.notna(df_out.at[i, "longitude"]):
-        continue
-
-    name = df_out.at[i, "Truckstop Name"]
-    city = df_out.at[i, "City"]
-    state = df_out.at[i, "State"]
-    address = df_out.at[i, "Address"]
-
-    # Estrategias optimizadas
-    queries = [
-        f"{address}, {city}, {state}, USA",
-        f"{name}, {city}, {state}, USA",
-        f"{city}, {state}, USA",
-        f"{state}, USA"
-    ]
-
-    coords = None
-    for q in queries:
-        coords = geocode(q)
-        if coords:
+# Las coordenadas se escriben en arrays y se vuelcan en bloque al DataFrame.
+lat_out = pd.to_numeric(df_out["latitude"], errors="coerce").to_numpy(dtype=float, copy=True)
+lon_out = pd.to_numeric(df_out["longitude"], errors="coerce").to_numpy(dtype=float, copy=True)
+
+mask = np.isnan(lat_out) | np.isnan(lon_out)
+todo_idx = np.where(mask)[0]
+todo = df_out.iloc[todo_idx]
+todo.index = todo_idx
+
+# Campos vacíos como NA: las consultas que los usan quedan en NA y se omiten.
+# Una dirección igual a la ciudad no aporta precisión, se trata como vacía.
+fields = {
+    c: todo[c].astype("string").str.strip().replace("", pd.NA)
+    for c in ("Truckstop Name", "Address", "City", "State")
+}
+address = fields["Address"].mask(
+    fields["Address"].str.lower().eq(fields["City"].str.lower()).fillna(False)
+)
+
+# Estrategias por nivel de precisión. Las consultas de ciudad/estado se repiten
+# entre miles de filas: se geocodifica cada consulta única una sola vez y se
+# une de vuelta a las filas con .map().
+city_state = fields["City"] + ", " + fields["State"] + ", USA"
+query_levels = [
+    address + ", " + city_state,
+    fields["Truckstop Name"] + ", " + city_state,
+    city_state,
+    fields["State"] + ", USA",
+]
+
+def geocode_unique(queries):
+    results = {}
+    futures = {executor.submit(geocode, q): q for q in queries}
+    for n, future in enumerate(as_completed(futures), 1):
+        q = futures[future]
+        results[q] = future.result()
+        print(f"{'✓' if results[q] else '✗'} {q} → {results[q]}")
+
+        if n % SAVE_EVERY == 0:
+            cache_commit()
+            print(f"💾 Guardado incremental de caché ({n}/{len(futures)} consultas)")
+    return results
+
+
+def flush_coords():
+    df_out.loc[mask, ["latitude", "longitude"]] = np.column_stack((lat_out[mask], lon_out[mask]))
+
+
+executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+pending = todo.index
+
+# Ante una interrupción (Ctrl-C) se cancelan las consultas en cola para no seguir
+# golpeando Nominatim, y se confirma en la caché lo ya resuelto para reanudar.
+try:
+    for level, keys in enumerate(query_levels, 1):
+        if pending.empty:
             break
-        time.sleep(1)  # rate limit Nominatim
 
-    if coords:
-        lat, lon = coords
-        df_out.at[i, "latitude"] = lat
-        df_out.at[i, "longitude"] = lon
-        print(f"{i} ✓ {name}, {city}, {state} → {coords}")
-    else:
-        print(f"{i} ✗ No encontrado: {name} - {city}, {state}")
+        # Se omiten consultas vacías o ya intentadas para la misma fila en un nivel anterior
+        keys = keys.loc[pending]
+        skip = keys.isna()
+        for prev_keys in query_levels[:level - 1]:
+            skip |= keys.eq(prev_keys.loc[pending]).fillna(False)
+        keys = keys[~skip]
+
+        resolved = geocode_unique(keys.unique())
+        coords = keys.map(resolved)
+        found = coords.notna()
+
+        rows = coords.index[found]
+        if found.any():
+            latlon = np.array(coords[found].tolist(), dtype=float)
+            lat_out[rows] = latlon[:, 0]
+            lon_out[rows] = latlon[:, 1]
+
+        pending = pending.difference(coords.index[found])
+        print(f"Nivel {level}: {int(found.sum())} filas resueltas con {len(resolved)} consultas únicas, {len(pending)} pendientes")
 
-    changes_since_save += 1
+        # Checkpoint: sólo se escriben las filas nuevas, no todo el CSV
+        pd.DataFrame({"row": rows, "latitude": lat_out[rows], "longitude": lon_out[rows]}).to_csv(
+            PROGRESS_CSV, mode="a", header=not os.path.exists(PROGRESS_CSV), index=False
+        )
+        cache_commit()
+        print(f"💾 Guardado incremental tras nivel {level} ({len(rows)} filas)")
+finally:
+    _stop_requests.set()
+    executor.shutdown(wait=False, cancel_futures=True)
+    cache_commit()
 
-    if changes_since_save >= SAVE_EVERY:
-        df_out.to_csv(OUTPUT_CSV, index=False)
-        with open(CACHE_FILE, "w", encoding="utf-8") as f:
-            json.dump(cache, f, indent=2)
-        print(f"💾 Guardado incremental en fila {i}")
-        changes_since_save = 0
+for i in pending:
+    print(f"{i} ✗ No encontrado: {todo.at[i, 'Truckstop Name']} - {todo.at[i, 'City']}, {todo.at[i, 'State']}")
 
 
 # ===============================
 # GUARDADO FINAL
 # ===============================
+flush_coords()
 df_out.to_csv(OUTPUT_CSV, index=False)
-with open(CACHE_FILE, "w", encoding="utf-8") as f:
-    json.dump(cache, f, indent=2)
+if os.path.exists(PROGRESS_CSV):
+    os.remove(PROGRESS_CSV)
+cache_commit()
+cache_conn.close()
 
 print("🚀 Geocodificación completada.")
@@ -1,4 +1,6 @@
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 
 # Cargar el dataset original
 df = pd.read_csv("datasets\\fuel-prices-for-be-assessment.csv")
@@ -21,17 +23,22 @@ df_us = df[df["State"].isin(us_states)].copy()
 # 2. Crear clave única por dirección
 # ---------------------------
 
-df_us["address_key"] = (
-    df_us["Address"].str.strip() + ", " +
-    df_us["City"].str.strip() + ", " +
-    df_us["State"].str.strip()
-)
+address = df_us["Address"].str.strip()
+city = df_us["City"].str.strip()
+state = df_us["State"].str.strip()
+df_us["address_key"] = address.str.cat([city, state], sep=", ")
 
 # ---------------------------
 # 3. Eliminar direcciones repetidas
 # ---------------------------
 
-df_unique = df_us.drop_duplicates(subset=["address_key"])
+# Hash table vectorizado de Arrow: para cada clave nos quedamos con la primera fila
+# (mínimo índice) y luego restauramos el orden original.
+tbl = pa.Table.from_pandas(df_us, preserve_index=False)
+tbl = tbl.append_column("__row", pa.array(range(len(tbl)), type=pa.int64()))
+first_rows = tbl.group_by("address_key", use_threads=False).aggregate([("__row", "min")])["__row_min"]
+first_rows = pc.take(first_rows, pc.sort_indices(first_rows))
+df_unique = tbl.take(first_rows).drop_columns(["__row"]).to_pandas()
 
 # ---------------------------
 # 4. Guardar el nuevo CSV
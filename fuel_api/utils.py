@@ -1,8 +1,20 @@
+import os
+import random
+import threading
+import time
+from functools import lru_cache
+import joblib
+import orjson
 import pandas as pd
 import numpy as np
+import sklearn
 from math import radians, cos, sin, sqrt, atan2
 from sklearn.neighbors import BallTree
+from shapely.geometry import LineString
+from numba import njit, vectorize, guvectorize
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from decouple import config
 
 # ---------------------------
@@ -10,8 +22,17 @@ from decouple import config
 # ---------------------------
 ORS_API_KEY = config("ORS_API_KEY")
 ORS_DIRECTIONS_URL = "https://api.openrouteservice.org/v2/directions/driving-car/geojson"
+ROUTE_CACHE_SIZE = 4096
+ROUTE_CACHE_DECIMALS = 3 # ~100 m: orígenes/destinos cercanos comparten ruta cacheada
+ORS_MAX_ATTEMPTS = 4
+ORS_MAX_CONCURRENCY = 4
+ORS_MAX_BACKOFF_SECONDS = 60.0
+ORS_TOTAL_BUDGET_SECONDS = 20.0 # tope de tiempo por llamada, sumando intentos y esperas
 
 TRUCKSTOPS_CSV = './datasets/truckstops_geocoded.csv'
+TRUCKSTOPS_CACHE = './datasets/truckstops_geocoded.joblib' # DataFrame + arrays + BallTree serializados
+# Sólo las columnas que usan el BallTree, el scoring y la respuesta
+STATIONS_COLUMNS = ["Truckstop Name", "City", "State", "Retail Price", "latitude", "longitude"]
 OUTPUT_CSV = "trip_plan_stops.csv"
 
 MILES_PER_STOP = 450.0
@@ -20,82 +41,227 @@ MIN_DEVIATION_KM = 0.35
 ALPHA = 1.0
 BETA = 3.0
 R_earth_km = 6371.0
+MAP_SIMPLIFY_TOLERANCE_DEG = 0.001 # ~100 m, imperceptible al zoom del mapa
 
 # ---------------------------
 # CARGA DE DATOS (GLOBAL - SE EJECUTA UNA VEZ)
 # ---------------------------
-print("Cargando Truckstops y generando BallTree...")
-try:
-    GLOBAL_STATIONS_DF = pd.read_csv(TRUCKSTOPS_CSV)
+def build_stations():
+    df = pd.read_csv(
+        TRUCKSTOPS_CSV,
+        usecols=STATIONS_COLUMNS,
+        dtype={"Retail Price": np.float64, "latitude": np.float64, "longitude": np.float64}
+    )
     # Filtrar datos válidos
-    GLOBAL_STATIONS_DF = GLOBAL_STATIONS_DF[
-        GLOBAL_STATIONS_DF["latitude"].notna() & 
-        GLOBAL_STATIONS_DF["longitude"].notna()
+    df = df[
+        df["latitude"].notna() & 
+        df["longitude"].notna()
     ].reset_index(drop=True)
     
+    # Columnas numéricas como arrays (SoA) para el scoring de candidatos
+    lats = df["latitude"].to_numpy()
+    lons = df["longitude"].to_numpy()
+    prices = df["Retail Price"].to_numpy()
+
     # Crear BallTree una sola vez
-    GLOBAL_STATIONS_TREE = BallTree(
-        np.radians(GLOBAL_STATIONS_DF[["latitude", "longitude"]].values), 
-        metric='haversine'
-    )
+    tree = BallTree(np.radians(np.column_stack((lats, lons))), metric='haversine')
+    return df, lats, lons, prices, tree
+
+@lru_cache(maxsize=None)
+def load_stations():
+    """
+    Carga estaciones y BallTree desde el cache joblib si corresponde al mtime actual
+    del CSV, a las versiones de pandas/sklearn/joblib y a STATIONS_COLUMNS; si no,
+    los construye y guarda el cache. Con mmap_mode="r" los arrays quedan mapeados
+    en memoria y los workers comparten el page cache del SO.
+    """
+    cache_key = {
+        "csv_mtime": os.path.getmtime(TRUCKSTOPS_CSV),
+        "pandas": pd.__version__,
+        "sklearn": sklearn.__version__,
+        "joblib": joblib.__version__,
+        "columns": list(STATIONS_COLUMNS),
+    }
+    if os.path.exists(TRUCKSTOPS_CACHE):
+        try:
+            cached = joblib.load(TRUCKSTOPS_CACHE, mmap_mode="r")
+            # Cualquier diferencia en la clave (CSV, librerías o columnas) reconstruye
+            if cached.get("key") == cache_key:
+                return cached["stations"]
+        except Exception as e:
+            print(f"Cache de estaciones inválido, reconstruyendo: {e}")
+
+    stations = build_stations()
+    try:
+        # Escritura atómica: otros workers nunca leen un cache a medio escribir
+        tmp_path = f"{TRUCKSTOPS_CACHE}.{os.getpid()}.tmp"
+        joblib.dump({"key": cache_key, "stations": stations}, tmp_path)
+        os.replace(tmp_path, TRUCKSTOPS_CACHE)
+    except OSError as e:
+        print(f"No se pudo guardar el cache de estaciones: {e}")
+    return stations
+
+print("Cargando Truckstops y generando BallTree...")
+try:
+    (GLOBAL_STATIONS_DF, GLOBAL_STATIONS_LATS, GLOBAL_STATIONS_LONS,
+     GLOBAL_STATIONS_PRICES, GLOBAL_STATIONS_TREE) = load_stations()
     print(f"Datos cargados: {len(GLOBAL_STATIONS_DF)} estaciones.")
 except Exception as e:
     print(f"Error cargando CSV: {e}")
     GLOBAL_STATIONS_DF = pd.DataFrame()
+    GLOBAL_STATIONS_LATS = GLOBAL_STATIONS_LONS = GLOBAL_STATIONS_PRICES = np.empty(0)
     GLOBAL_STATIONS_TREE = None
 
 # ---------------------------
 # UTIL (Vectorizado y Geografía)
 # ---------------------------
-def haversine_km(lat1, lon1, lat2, lon2):
-    """Calcula haversine para escalares o arrays numpy."""
+@njit(cache=True, fastmath=True, inline="always")
+def _haversine_scalar(lat1, lon1, lat2, lon2):
     dlat = np.radians(lat2 - lat1)
     dlon = np.radians(lon2 - lon1)
     a = np.sin(dlat/2)**2 + np.cos(np.radians(lat1)) * np.cos(np.radians(lat2)) * np.sin(dlon/2)**2
     c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1-a))
     return R_earth_km * c
 
+@vectorize(["float64(float64, float64, float64, float64)"], cache=True, fastmath=True)
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Calcula haversine para escalares o arrays numpy (ufunc JIT, sin temporales)."""
+    return _haversine_scalar(lat1, lon1, lat2, lon2)
+
 def km_to_miles(km): return km / 1.609344
 def miles_to_km(mi): return mi * 1.609344
 
-def vectorized_segment_projection(px, py, x1, y1, x2, y2):
+@guvectorize(
+    ["void(float64, float64, float64[:], float64[:], float64[:], float64[:], float64[:], float64[:])"],
+    "(),(),(k),(k),(k),(k)->(k),(k)",
+    cache=True, fastmath=True,
+)
+def vectorized_segment_projection(px, py, x1, y1, x2, y2, out_dist, out_t):
     """
     Calcula la distancia mínima y el factor t de un punto (px, py) 
     a múltiples segmentos definidos por arrays (x1, y1) -> (x2, y2).
     Usamos aproximación euclidiana para el factor t (proyección) por velocidad,
     y luego Haversine para la distancia real.
+    Kernel JIT en una sola pasada: devuelve (dists_km, t) y acepta out= para
+    reutilizar buffers entre llamadas.
     """
-    # Vectores segmento (vx, vy) y punto-inicio (wx, wy)
-    vx, vy = x2 - x1, y2 - y1
-    wx, wy = px - x1, py - y1
-    
-    # Producto punto y longitud cuadrada del segmento
-    vv = vx*vx + vy*vy
-    dot = wx*vx + wy*wy
-    
-    # Evitar división por cero
-    with np.errstate(divide='ignore', invalid='ignore'):
-        t = dot / vv
-        t = np.nan_to_num(t) # Reemplazar NaN con 0 si vv es 0
-    
-    # Clampear t entre 0 y 1
-    t = np.clip(t, 0.0, 1.0)
-    
-    # Punto proyectado
-    projx = x1 + t*vx
-    projy = y1 + t*vy
-    
-    # Distancia real Haversine desde el punto P hasta la proyección
-    dists_km = haversine_km(py, px, projy, projx)
-    
-    return dists_km, t
+    for k in range(x1.shape[0]):
+        # Vectores segmento (vx, vy) y punto-inicio (wx, wy)
+        vx, vy = x2[k] - x1[k], y2[k] - y1[k]
+        wx, wy = px - x1[k], py - y1[k]
+
+        # Producto punto y longitud cuadrada del segmento
+        vv = vx*vx + vy*vy
+        dot = wx*vx + wy*wy
+
+        # Evitar división por cero y clampear t entre 0 y 1
+        t = dot / vv if vv > 0.0 else 0.0
+        t = min(max(t, 0.0), 1.0)
+
+        # Distancia real Haversine desde el punto P hasta la proyección
+        out_dist[k] = _haversine_scalar(py, px, y1[k] + t*vy, x1[k] + t*vx)
+        out_t[k] = t
 
 # ---------------------------
 # 1) Obtener ruta ORS (Optimizado)
 # ---------------------------
+ORS_SESSION = requests.Session()
+ORS_SESSION.headers.update({"Authorization": ORS_API_KEY, "Content-Type": "application/json"})
+
+# Control de admisión AIMD: el límite de requests concurrentes a ORS sube +1 con
+# cada respuesta sana y se reduce a la mitad ante 429/5xx o errores de red.
+_ors_admission = threading.Condition()
+_ors_limit = float(ORS_MAX_CONCURRENCY)
+_ors_in_flight = 0
+
+def _ors_acquire():
+    global _ors_in_flight
+    with _ors_admission:
+        while _ors_in_flight >= int(_ors_limit):
+            _ors_admission.wait()
+        _ors_in_flight += 1
+
+def _ors_release(overloaded):
+    global _ors_in_flight, _ors_limit
+    with _ors_admission:
+        _ors_in_flight -= 1
+        if overloaded:
+            _ors_limit = max(1.0, _ors_limit * 0.5)
+        else:
+            _ors_limit = min(float(ORS_MAX_CONCURRENCY), _ors_limit + 1.0)
+        _ors_admission.notify_all()
+
+def _ors_backoff_seconds(resp, attempt):
+    # Respetar Retry-After si viene en segundos; si no, backoff exponencial con jitter
+    try:
+        delay = float(resp.headers["Retry-After"])
+    except (KeyError, ValueError):
+        delay = 2 ** attempt + random.random()
+    return min(ORS_MAX_BACKOFF_SECONDS, delay)
+
+class ORSOverloadedError(requests.HTTPError):
+    """ORS sigue respondiendo 429/5xx tras agotar reintentos o el presupuesto de tiempo."""
+
+def _ors_overloaded(resp):
+    return resp.status_code == 429 or resp.status_code >= 500
+
+def ors_request(body_json, timeout):
+    """
+    POST a ORS con reintentos sólo ante 429/5xx, bajo el control de admisión AIMD.
+    Intentos y esperas comparten un presupuesto total de ORS_TOTAL_BUDGET_SECONDS.
+    """
+    deadline = time.monotonic() + ORS_TOTAL_BUDGET_SECONDS
+    for attempt in range(ORS_MAX_ATTEMPTS):
+        _ors_acquire()
+        overloaded = True
+        try:
+            remaining = max(0.1, deadline - time.monotonic())
+            resp = ORS_SESSION.post(ORS_DIRECTIONS_URL, data=body_json, timeout=min(timeout, remaining))
+            overloaded = _ors_overloaded(resp)
+        finally:
+            _ors_release(overloaded)
+
+        if not overloaded or attempt == ORS_MAX_ATTEMPTS - 1:
+            return resp
+
+        # Si la espera no entra en el presupuesto, devolvemos la respuesta de overload
+        delay = _ors_backoff_seconds(resp, attempt)
+        if time.monotonic() + delay >= deadline:
+            return resp
+        time.sleep(delay)
+
+@lru_cache(maxsize=ROUTE_CACHE_SIZE)
+def _ors_post_cached(body_json, timeout):
+    """
+    POST a ORS cacheado por body canónico. Devuelve el JSON crudo en bytes (inmutable);
+    si la respuesta no es 200 lanza HTTPError (ORSOverloadedError si es 429/5xx),
+    así los fallos no quedan en caché.
+    """
+    resp = ors_request(body_json, timeout)
+    if _ors_overloaded(resp):
+        raise ORSOverloadedError(f"ORS sobrecargado ({resp.status_code})", response=resp)
+    resp.raise_for_status()
+    return resp.content
+
+def ors_body_key(body):
+    # Coordenadas redondeadas (~100 m) para que la clave de caché agrupe puntos cercanos
+    coords = [[round(lon, ROUTE_CACHE_DECIMALS), round(lat, ROUTE_CACHE_DECIMALS)] for lon, lat in body["coordinates"]]
+    return orjson.dumps(dict(body, coordinates=coords), option=orjson.OPT_SORT_KEYS)
+
+def ors_post(body, timeout):
+    return orjson.loads(_ors_post_cached(ors_body_key(body), timeout))
+
+# Bodies con "radiuses" que ORS rechazó con 4xx: un par repetido va directo al body sin radios
+_radiuses_rejected = set()
+_radiuses_rejected_lock = threading.Lock()
+
+def _mark_radiuses_rejected(key):
+    with _radiuses_rejected_lock:
+        if len(_radiuses_rejected) >= ROUTE_CACHE_SIZE:
+            _radiuses_rejected.clear()
+        _radiuses_rejected.add(key)
+
 def get_route_geojson(start_lat, start_lon, end_lat, end_lon, simplify=True): # Default True
-    headers = {"Authorization": ORS_API_KEY, "Content-Type": "application/json"}
-    
     # Empezamos con un radio grande (5000m) para evitar reintentos innecesarios
     # si los puntos están en áreas rurales (común en logística).
     radiuses_initial = [5000, 5000] 
@@ -107,19 +273,22 @@ def get_route_geojson(start_lat, start_lon, end_lat, end_lon, simplify=True): #
         "radiuses": radiuses_initial
     }
 
+    radiuses_key = ors_body_key(body)
     try:
-        resp = requests.post(ORS_DIRECTIONS_URL, json=body, headers=headers, timeout=10)
-        if resp.status_code == 200:
-            return resp.json()
-        
-        # Si falla (ej. código 3), intentamos fallback sin radios (snap ilimitado o default)
-        # o aumentamos timeout. Aquí simplificamos para reducir peticiones.
-        if resp.status_code != 200:
-            # Fallback simple: intentar sin 'radiuses' para dejar que ORS decida
-            del body["radiuses"]
-            resp = requests.post(ORS_DIRECTIONS_URL, json=body, headers=headers, timeout=10)
-            if resp.status_code == 200:
-                return resp.json()
+        if radiuses_key not in _radiuses_rejected:
+            try:
+                return ors_post(body, timeout=10)
+            except ORSOverloadedError:
+                # 429/5xx tras los reintentos: otro intento sólo suma latencia, vamos a la línea recta
+                raise
+            except requests.HTTPError as e:
+                # Si falla (ej. código 3), intentamos fallback sin radios (snap ilimitado o default)
+                if e.response is None or not 400 <= e.response.status_code < 500:
+                    raise
+                _mark_radiuses_rejected(radiuses_key)
+        # Fallback simple: intentar sin 'radiuses' para dejar que ORS decida
+        del body["radiuses"]
+        return ors_post(body, timeout=10)
             
     except Exception as e:
         print(f"[ORS ERROR] {e}")
@@ -137,7 +306,6 @@ def get_route_geojson(start_lat, start_lon, end_lat, end_lon, simplify=True): #
 
 def get_route_geojson_with_waypoints(coords_list):
     # Lógica similar pero para múltiples puntos
-    headers = {"Authorization": ORS_API_KEY, "Content-Type": "application/json"}
     # Radio generoso para todos los waypoints para evitar errores de "Point not found"
     radiuses = [5000] * len(coords_list)
 
@@ -149,9 +317,7 @@ def get_route_geojson_with_waypoints(coords_list):
     }
 
     try:
-        resp = requests.post(ORS_DIRECTIONS_URL, json=body, headers=headers, timeout=20)
-        if resp.status_code == 200:
-            return resp.json()
+        return ors_post(body, timeout=20)
     except Exception:
         pass
 
@@ -165,7 +331,7 @@ def route_points_and_cumdist(route_geojson):
     # Coords vienen en [Lon, Lat], convertimos a Lat, Lon para lógica interna si prefieres,
     # pero aquí mantenemos coherencia. Usaremos Numpy arrays directamente.
     
-    coords_arr = np.array(coords) # Shape (N, 2) -> Lon, Lat
+    coords_arr = np.asarray(coords, dtype=np.float64) # Shape (N, 2) -> Lon, Lat (una sola alocación)
     lons = coords_arr[:, 0]
     lats = coords_arr[:, 1]
     
@@ -177,131 +343,146 @@ def route_points_and_cumdist(route_geojson):
     else:
         cumdist = np.array([0.0])
         
-    pts = list(zip(lats, lons)) # Lista de tuplas (lat, lon) para compatibilidad
+    pts = coords_arr[:, ::-1] # Vista (N, 2) -> Lat, Lon, sin copiar
     return pts, cumdist, lats, lons
 
+def simplify_route_pts(pts, tolerance=MAP_SIMPLIFY_TOLERANCE_DEG):
+    """Douglas-Peucker sobre puntos (lat, lon) para reducir el tamaño de la polilínea del mapa."""
+    if len(pts) < 3:
+        return np.asarray(pts).tolist()
+    simplified = LineString(pts).simplify(tolerance, preserve_topology=False)
+    return list(simplified.coords)
+
 # ---------------------------
 # 3) Lógica de Paradas (Vectorizada)
 # ---------------------------
-def point_on_route_at_distance(pts, cumdist, target_km):
-    if target_km >= cumdist[-1]:
-        return pts[-1], len(pts)-1, 1.0
+def points_on_route_at_distances(route_lats, route_lons, cumdist, targets_km):
+    """
+    Interpola los puntos de la ruta a las distancias dadas (todas a la vez).
+    Devuelve arrays (lats, lons, índice del segmento previo, fracción en el segmento).
+    """
+    targets_km = np.asarray(targets_km, dtype=np.float64)
+    last = len(cumdist) - 1
     
-    # searchsorted es muy rápido (búsqueda binaria)
-    idx = np.searchsorted(cumdist, target_km)
-    prev = max(0, idx - 1)
+    # searchsorted en modo batch (búsqueda binaria para todos los targets)
+    idx = np.minimum(np.searchsorted(cumdist, targets_km), last)
+    prev = np.maximum(0, idx - 1)
     
     start_km = cumdist[prev]
-    end_km = cumdist[idx]
-    seg_len = end_km - start_km
+    seg_len = cumdist[idx] - start_km
     
-    frac = 0.0
-    if seg_len > 0:
-        frac = (target_km - start_km) / seg_len
-        
-    lat1, lon1 = pts[prev]
-    lat2, lon2 = pts[idx]
+    frac = np.zeros_like(targets_km)
+    np.divide(targets_km - start_km, seg_len, out=frac, where=seg_len > 0)
     
-    lat = lat1 + frac * (lat2 - lat1)
-    lon = lon1 + frac * (lon2 - lon1)
+    lats = route_lats[prev] + frac * (route_lats[idx] - route_lats[prev])
+    lons = route_lons[prev] + frac * (route_lons[idx] - route_lons[prev])
     
-    return (lat, lon), prev, frac
-
-def best_station_for_stop(stop_point, stop_route_index, prev_route_km, 
-                          route_lats, route_lons, route_cumdist, current_max_deviation_miles):
+    # Targets más allá del final: último punto de la ruta
+    past_end = targets_km >= cumdist[-1]
+    lats[past_end] = route_lats[-1]
+    lons[past_end] = route_lons[-1]
+    prev[past_end] = last
+    frac[past_end] = 1.0
     
-    lat_target, lon_target = stop_point
-    radius_km = miles_to_km(current_max_deviation_miles)
-    
-    # 1. Query espacial rápida con BallTree (Global)
-    q_rad = np.radians([[lat_target, lon_target]]) # Shape (1, 2)
-    idxs = GLOBAL_STATIONS_TREE.query_radius(q_rad, r=radius_km/R_earth_km)[0]
+    return lats, lons, prev, frac
+
+def stations_within_radius(points, radius_miles):
+    """
+    Query espacial con BallTree (Global) para varios puntos (lat, lon) a la vez.
+    Devuelve un array de índices de estaciones por punto.
+    """
+    radius_km = miles_to_km(radius_miles)
+    q_rad = np.radians(np.asarray(points, dtype=np.float64).reshape(-1, 2)) # Shape (n, 2)
+    return GLOBAL_STATIONS_TREE.query_radius(q_rad, r=radius_km/R_earth_km)
+
+def route_segments(route_lats, route_lons, route_cumdist):
+    """Geometría de los segmentos i -> i+1 de la ruta, calculada una vez por viaje."""
+    return {
+        "lons1": route_lons[:-1],
+        "lats1": route_lats[:-1],
+        "lons2": route_lons[1:],
+        "lats2": route_lats[1:],
+        "base_cumdist": route_cumdist[:-1],
+        "lengths": np.diff(route_cumdist),
+    }
+
+def best_station_for_stop(idxs, stop_route_index, prev_route_km, route_segs):
     
+    # 1. idxs: estaciones candidatas ya obtenidas del BallTree
     if len(idxs) == 0: 
         return None
 
-    # Candidatos subset
-    candidates = GLOBAL_STATIONS_DF.iloc[idxs].copy()
-    
     # 2. Definir ventana de segmentos de ruta (Optimization)
     # Al usar simplify=True, hay menos puntos, una ventana de 100 es suficiente y segura
     window = 200 
-    n_pts = len(route_lats)
+    n_segs = len(route_segs["lengths"])
     start_seg = max(0, stop_route_index - window)
-    end_seg = min(n_pts - 2, stop_route_index + window)
+    end_seg = min(n_segs - 1, stop_route_index + window)
     
     if start_seg > end_seg: # Caso borde
         start_seg = 0
-        end_seg = max(0, n_pts - 2)
+        end_seg = max(0, n_segs - 1)
 
-    # Extraer coordenadas del segmento relevante como Arrays
+    # Ventana de segmentos precalculados (vistas, sin copias)
     # x = Lon, y = Lat
     # Segmentos van de i a i+1
-    seg_lons1 = route_lons[start_seg:end_seg+1]
-    seg_lats1 = route_lats[start_seg:end_seg+1]
-    seg_lons2 = route_lons[start_seg+1:end_seg+2]
-    seg_lats2 = route_lats[start_seg+1:end_seg+2]
+    window_slice = slice(start_seg, end_seg + 1)
+    seg_lons1 = route_segs["lons1"][window_slice]
+    seg_lats1 = route_segs["lats1"][window_slice]
+    seg_lons2 = route_segs["lons2"][window_slice]
+    seg_lats2 = route_segs["lats2"][window_slice]
     
     # Arrays de distancias acumuladas base para estos segmentos
-    seg_base_cumdist = route_cumdist[start_seg:end_seg+1]
-    seg_lengths = route_cumdist[start_seg+1:end_seg+2] - seg_base_cumdist
+    seg_base_cumdist = route_segs["base_cumdist"][window_slice]
+    seg_lengths = route_segs["lengths"][window_slice]
 
-    best_candidates_list = []
+    # Candidatos como arrays (M,) y segmentos como (K,): el kernel hace broadcasting
+    # y devuelve matrices (M, K) en una sola llamada, sin iterrows.
+    cand_lats = GLOBAL_STATIONS_LATS[idxs]
+    cand_lons = GLOBAL_STATIONS_LONS[idxs]
+    cand_prices = GLOBAL_STATIONS_PRICES[idxs]
 
-    # Iteramos sobre candidatos (normalmente son pocos, ej. < 50)
-    # Pero vectorizamos el cálculo contra TODOS los segmentos de la ventana a la vez
-    for idx_cand, cand in candidates.iterrows():
-        c_lat, c_lon = cand["latitude"], cand["longitude"]
-        
-        # MAGIA VECTORIZADA: Calculamos dist a 200 segmentos simultáneamente
-        dists, ts = vectorized_segment_projection(
-            c_lon, c_lat, 
-            seg_lons1, seg_lats1, 
-            seg_lons2, seg_lats2
-        )
-        
-        # Encontrar el segmento con la distancia mínima para este candidato
-        min_idx_local = np.argmin(dists)
-        min_dist_km = dists[min_idx_local]
-        best_t = ts[min_idx_local]
-        
-        # Calcular KM proyectado en ruta
-        proj_km = seg_base_cumdist[min_idx_local] + best_t * seg_lengths[min_idx_local]
-        
-        # Filtro de progresión (no ir hacia atrás)
-        if proj_km < prev_route_km - 1e-3:
-            continue
-            
-        min_dist_km = max(min_dist_km, MIN_DEVIATION_KM) # Floor deviation
-        
-        score = min_dist_km * ALPHA + cand["Retail Price"] * BETA
-        
-        best_candidates_list.append({
-            "data": cand,
-            "deviation_km": min_dist_km,
-            "proj_route_km": proj_km,
-            "score": score
-        })
-
-    if not best_candidates_list:
+    dists, ts = vectorized_segment_projection(
+        cand_lons, cand_lats,
+        seg_lons1, seg_lats1,
+        seg_lons2, seg_lats2
+    )
+
+    # Segmento más cercano por candidato
+    rows = np.arange(len(idxs))
+    min_idx = dists.argmin(axis=1)
+    min_dists = dists[rows, min_idx]
+
+    # KM proyectado en ruta
+    proj_kms = seg_base_cumdist[min_idx] + ts[rows, min_idx] * seg_lengths[min_idx]
+
+    min_dists = np.maximum(min_dists, MIN_DEVIATION_KM) # Floor deviation
+    scores = min_dists * ALPHA + cand_prices * BETA
+
+    # Filtro de progresión (no ir hacia atrás): candidatos inválidos con score infinito
+    invalid = (proj_kms < prev_route_km - 1e-3) | np.isnan(scores)
+    scores[invalid] = np.inf
+
+    # Mejor score en O(M) con argmin (sin ordenar)
+    best_pos = int(np.argmin(scores))
+    if not np.isfinite(scores[best_pos]):
         return None
-        
-    # Ordenar por score y devolver el mejor
-    best_candidates_list.sort(key=lambda x: x["score"])
-    best_obj = best_candidates_list[0]
-    best_cand = best_obj["data"]
+
+    # Sólo la estación elegida se materializa como fila de pandas
+    best_idx = int(idxs[best_pos])
+    best_cand = GLOBAL_STATIONS_DF.iloc[best_idx]
     
     return {
-        "idx": int(best_cand.name), # o ID original
+        "idx": best_idx, # o ID original
         "Truckstop Name": best_cand.get("Truckstop Name"),
         "City": best_cand.get("City"),
         "State": best_cand.get("State"),
         "Retail Price": float(best_cand.get("Retail Price")),
         "latitude": float(best_cand.get("latitude")),
         "longitude": float(best_cand.get("longitude")),
-        "deviation_km": float(best_obj["deviation_km"]),
-        "proj_route_km": float(best_obj["proj_route_km"]),
-        "score": float(best_obj["score"])
+        "deviation_km": float(min_dists[best_pos]),
+        "proj_route_km": float(proj_kms[best_pos]),
+        "score": float(scores[best_pos])
     }
 
 # ---------------------------
@@ -318,26 +499,31 @@ def plan_trip(start_lat, start_lon, end_lat, end_lon):
     # 2) Target stops
     n_stops = int(np.floor(total_miles / MILES_PER_STOP))
     if n_stops == 0:
-        return [], pts_list, pts_list
+        return [], pts_list, pts_list, total_miles
+
+    stop_km_markers = miles_to_km(np.arange(1, n_stops + 1) * MILES_PER_STOP)
+    
+    # Encontrar puntos aproximados en la ruta simplificada (todas las paradas a la vez)
+    stop_lats, stop_lons, stop_seg_idxs, _ = points_on_route_at_distances(
+        lats_arr, lons_arr, cumdist_arr, stop_km_markers
+    )
+    stop_pts = np.column_stack((stop_lats, stop_lons))
 
-    stop_km_markers = [miles_to_km((i+1) * MILES_PER_STOP) for i in range(n_stops)]
+    # Radios crecientes: el primero se consulta para todas las paradas en una sola llamada
+    search_radii = [MAX_DEVIATION_MILES, 50, 100, 150]
+    first_pass_idxs = stations_within_radius(stop_pts, search_radii[0])
     
+    route_segs = route_segments(lats_arr, lons_arr, cumdist_arr)
+
     results = []
     prev_proj_km = 0.0
     
     # 3) Buscar paradas
-    for stop_km in stop_km_markers:
-        # Encontrar punto aproximado en la ruta simplificada
-        stop_pt, idx_seg, frac = point_on_route_at_distance(pts_list, cumdist_arr, stop_km)
-        
+    for j, (stop_pt, idx_seg) in enumerate(zip(stop_pts, stop_seg_idxs)):
         best = None
-        # Radios crecientes pasados como argumento (no global variable modification)
-        for r_miles in [MAX_DEVIATION_MILES, 50, 100, 150]:
-            best = best_station_for_stop(
-                stop_pt, idx_seg, prev_proj_km, 
-                lats_arr, lons_arr, cumdist_arr, 
-                r_miles # Pasamos el radio dinámico
-            )
+        for r_i, r_miles in enumerate(search_radii):
+            idxs = first_pass_idxs[j] if r_i == 0 else stations_within_radius(stop_pt, r_miles)[0]
+            best = best_station_for_stop(idxs, idx_seg, prev_proj_km, route_segs)
             if best:
                 break
         
@@ -366,12 +552,22 @@ def plan_trip(start_lat, start_lon, end_lat, end_lon):
 # GEOCODIFICACIÓN US
 # ---------------------------
 USER_AGENT = "Mozilla/5.0 (compatible; RoutePlanner/1.0)"
+
+# Sesión persistente: reutiliza la conexión TCP+TLS con Nominatim entre requests
+# y reintenta 429/5xx con backoff sobre el mismo socket.
+NOMINATIM_SESSION = requests.Session()
+NOMINATIM_SESSION.headers.update({"User-Agent": USER_AGENT})
+NOMINATIM_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=1,
+    max_retries=Retry(total=3, backoff_factor=1, status_forcelist=[429, 502, 503, 504]),
+))
+
 def geocode_us_location(address):
     url = "https://nominatim.openstreetmap.org/search"
     params = {"q": address, "format": "json", "countrycodes":"us","limit":1}
-    headers = {"User-Agent": USER_AGENT}
     try:
-        r = requests.get(url, params=params, headers=headers, timeout=10)
+        r = NOMINATIM_SESSION.get(url, params=params, timeout=10)
         r.raise_for_status()
         data = r.json()
         if not data: return None
@@ -7,7 +7,7 @@ from rest_framework import status
 import folium
 
 # Asegúrate de que plan_trip devuelve 4 valores ahora
-from .utils import geocode_us_location, plan_trip
+from .utils import geocode_us_location, plan_trip, simplify_route_pts
 
 @api_view(["POST"])
 def generate_route(request):
@@ -64,8 +64,10 @@ def generate_route(request):
     folium.Marker([lat1, lon1], tooltip=f"Start: {origin}", icon=folium.Icon(color="green", icon="play")).add_to(m)
     folium.Marker([lat2, lon2], tooltip=f"End: {destination}", icon=folium.Icon(color="red", icon="stop")).add_to(m)
 
-    final_route = opt_route_pts if opt_route_pts else route_pts
-    if final_route:
+    final_route = opt_route_pts if len(opt_route_pts) else route_pts
+    if len(final_route):
+        # Menos puntos en la polilínea = HTML más chico y render más rápido
+        final_route = simplify_route_pts(final_route)
         folium.PolyLine(final_route, weight=5, opacity=0.7, color="blue").add_to(m)
 
     for i, stop in enumerate(stops, 1):